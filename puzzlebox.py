@@ -4,13 +4,20 @@ Puzzle Box Generator - Web Server
 Wraps the C generator binary with a modern web interface
 """
 
+import base64
+import hashlib
+import mimetypes
 import os
 import re
 import subprocess
 import tempfile
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
 import json
 
 # Configuration
@@ -18,10 +25,202 @@ PORT = int(os.environ.get('PORT', 8080))
 GENERATOR_PATH = Path(__file__).parent / "generator" / "puzzlebox"
 STATIC_DIR = Path(__file__).parent
 
+# Frontend files opened once at startup: URL path -> (file, size, etag, type, mtime)
+STATIC_FILES = {}
+
+# URL parameter -> generator option, and whether it is a flag (takes no value)
+GENERATOR_OPTIONS = (
+    # Flags (no value)
+    ('l', '--stl', True),
+    ('R', '--resin', True),
+    ('i', '--inside', True),
+    ('f', '--flip', True),
+    ('q', '--core-solid', True),
+    ('v', '--park-vertical', True),
+    ('W', '--base-wide', True),
+    ('d', '--text-slow', True),
+    ('O', '--text-outset', True),
+    ('V', '--symmetric-cut', True),
+    ('Q', '--test', True),
+    # Values
+    ('m', '--parts', False),
+    ('c', '--core-diameter', False),
+    ('h', '--core-height', False),
+    ('C', '--core-gap', False),
+    ('E', '--text-end', False),
+    ('I', '--text-inside', False),
+    ('S', '--text-side', False),
+    ('n', '--part', False),
+    ('N', '--nubs', False),
+    ('H', '--helix', False),
+    ('b', '--base-height', False),
+    ('w', '--part-thickness', False),
+    ('t', '--maze-thickness', False),
+    ('z', '--maze-step', False),
+    ('M', '--maze-margin', False),
+    ('X', '--maze-complexity', False),
+    ('p', '--park-thickness', False),
+    ('B', '--base-thickness', False),
+    ('Z', '--base-gap', False),
+    ('g', '--clearance', False),
+    ('y', '--nub-r-clearance', False),
+    ('s', '--outer-sides', False),
+    ('r', '--outer-round', False),
+    ('G', '--grip-depth', False),
+    ('D', '--text-depth', False),
+    ('F', '--text-font', False),
+    ('e', '--text-font-end', False),
+    ('T', '--text-side-scale', False),
+    ('U', '--text-end-scale', False),
+    ('J', '--text-inside-scale', False),
+    ('L', '--logo-depth', False),
+)
+
+# Downloads up to this size are kept in memory and cached; larger ones are
+# sent straight from the spool file
+SPOOL_CACHE_LIMIT = 64 * 1024
+
+# Requests are served on threads; cap concurrent generator runs at the CPU count
+_GEN_SEM = threading.BoundedSemaphore(os.cpu_count() or 4)
+
+# Generated output is cached per parameter set; entries can be multi-MB (STL)
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 32))
+
+
+class _LRUCache:
+    """Bounded mapping that evicts the least recently used entry"""
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached value (marking it recently used) or None"""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+    
+    def put(self, key, value):
+        """Store a value, evicting the oldest entry when full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# SCAD parsing patterns (compiled once; matched at offsets found by str.find)
+_PART_RE = re.compile(r'// (Part \d+)')
+_NUM_RE = re.compile(r'\d+')
+# Geometry primitives kept when building standalone parts
+_GEOMETRY_KEYWORDS = ('polyhedron(', 'cylinder(', 'cube(', 'sphere(',
+                      'rotate(', 'for(', 'translate(', 'difference(',
+                      'union(', 'intersection(', 'hull(', 'minkowski(')
+
+# OpenSCAD Customizer metadata (shows in MakerWorld Customize panel), filled
+# with an optional _part line and the share ID
+_WATERMARK_HEADER_TMPL = (
+    '/* [About This Model] */\n'
+    '%s'
+    '_generator = "PuzzleBoxGenerator"; // Generated by\n'
+    '_site = "https://puzzlebox-r92r.onrender.com"; // Generate yours\n'
+    '_creator = "Rogerio Camorim"; // Original Creator\n'
+    '_makerworld = "https://makerworld.com/en/@camorimcanada"; // MakerWorld\n'
+    '_version = "1.0.0"; // Version\n'
+    '_share_id = "%s"; // Share ID (use to regenerate)\n'
+    '\n'
+    '/* [Hidden] */\n'
+    '\n'
+)
+
+# Raw generator stdout keyed by argv, and polyhedron responses keyed by params
+_OUTPUT_CACHE = _LRUCache(CACHE_SIZE)
+_PARTS_CACHE = _LRUCache(CACHE_SIZE)
+
+
+def _generator_signature():
+    """Identify the generator build so cached output is dropped when it changes"""
+    try:
+        st = GENERATOR_PATH.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _iter_line_prefix(text, prefix, start=0, end=None, indented=False):
+    """Yield offsets where prefix begins a line of text (after indentation if allowed)"""
+    # Jumping between candidates with str.find avoids splitting a multi-MB
+    # SCAD file into one string per line just to test a handful of them
+    if end is None:
+        end = len(text)
+    idx = text.find(prefix, start, end)
+    while idx >= 0:
+        line_start = text.rfind('\n', 0, idx) + 1
+        if line_start == idx or (indented and text[line_start:idx].isspace()):
+            yield idx
+        idx = text.find(prefix, idx + 1, end)
+
+
+def _line_end(text, pos):
+    """Offset of the newline ending the line at pos (or end of text)"""
+    end = text.find('\n', pos)
+    return len(text) if end < 0 else end
+
+
+def _last_brace_line(text, start):
+    """Offset of the last line after the one at start that is just '}' (or -1)"""
+    # Walk back from the end: the scale block's closing brace is on the last
+    # lines, so this touches only the tail instead of the whole part
+    end = len(text)
+    while True:
+        nl = text.rfind('\n', start, end)
+        if nl < 0:
+            return -1
+        if text[nl + 1:end].strip() == '}':
+            return nl + 1
+        end = nl
+
+
+def _canonical_params(params):
+    """Sorted k=v&... form of the request parameters (the share ID payload)"""
+    return '&'.join(f"{k}={v}" for k, v in sorted(params.items()) if v).encode()
+
+
+def _b64id(data):
+    """Encode canonical parameter bytes as a URL-safe share ID"""
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def run_generator(args, timeout=120, stdout=subprocess.PIPE):
+    """Run the C generator and capture its output (or write stdout to a file)"""
+    # The generator only touches absolute paths (/dev/urandom, /tmp), so no cwd
+    # is needed. Leaving cwd unset and close_fds off (Python's own fds are
+    # already non-inheritable) lets subprocess use posix_spawn/vfork instead of
+    # a full fork() of the server process.
+    return subprocess.run(
+        args,
+        stdout=stdout,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
+        close_fds=False
+    )
+
 
 class PuzzleBoxHandler(SimpleHTTPRequestHandler):
     """Custom HTTP handler for Puzzle Box Generator"""
+
+    # Send headers and body without waiting on Nagle/delayed-ACK, and drop
+    # clients that stall mid-request instead of blocking the server loop
+    disable_nagle_algorithm = True
+    timeout = 30
     
+    # Decoded share IDs, so IDs pasted back into the frontend skip base64 work
+    _PARAMS_CACHE = _LRUCache(1024)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=str(STATIC_DIR), **kwargs)
     
@@ -36,31 +235,38 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         elif parsed.path == "/api/decode":
             self.handle_decode(parsed.query)
         else:
-            super().do_GET()
+            static = STATIC_FILES.get(parsed.path)
+            if static:
+                self.send_static_file(static)
+            else:
+                super().do_GET()
     
     def handle_decode(self, query_string):
         """Decode a share ID back to parameters"""
-        import base64
-        params = parse_qs(query_string)
+        params = dict(parse_qsl(query_string))
         
-        share_id = params.get('id', [''])[0]
+        share_id = params.get('id', '')
         if not share_id:
             self.send_json({"error": "No ID provided"}, status=400)
             return
         
-        try:
-            # Decode the base64 ID back to parameters
-            decoded = base64.urlsafe_b64decode(share_id + '==').decode()  # Add padding
-            param_pairs = decoded.split('&')
-            result = {}
-            for pair in param_pairs:
-                if '=' in pair:
-                    key, value = pair.split('=', 1)
-                    result[key] = value
-            
-            self.send_json({"params": result, "success": True})
-        except Exception as e:
-            self.send_json({"error": f"Invalid ID: {str(e)}"}, status=400)
+        result = self._PARAMS_CACHE.get(share_id)
+        if result is None:
+            try:
+                # Decode the base64 ID back to parameters
+                decoded = base64.urlsafe_b64decode(share_id + '==').decode()  # Add padding
+                param_pairs = decoded.split('&')
+                result = {}
+                for pair in param_pairs:
+                    if '=' in pair:
+                        key, value = pair.split('=', 1)
+                        result[key] = value
+            except Exception as e:
+                self.send_json({"error": f"Invalid ID: {str(e)}"}, status=400)
+                return
+            self._PARAMS_CACHE.put(share_id, result)
+        
+        self.send_json({"params": result, "success": True})
     
     def do_OPTIONS(self):
         """Handle CORS preflight"""
@@ -76,11 +282,31 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
     
     def send_json(self, data, status=200):
         """Send JSON response"""
+        # Compact separators: the polyhedron payload carries every part's SCAD code
+        body = json.dumps(data, separators=(',', ':')).encode()
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
         self.send_cors_headers()
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+    
+    def send_static_file(self, static):
+        """Serve a preloaded frontend file straight from the page cache"""
+        file, size, etag, content_type, last_modified = static
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", size)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        # sendfile(2): no per-request open/stat and no userspace copy
+        self.connection.sendfile(file, 0, size)
     
     def send_file_response(self, data, filename, content_type):
         """Send file download response"""
@@ -94,127 +320,130 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(data)
     
+    def send_generator_output(self, args, output_key, filename, content_type, timeout=120):
+        """Run the generator into a spool file and send it with sendfile()"""
+        # Spooling to disk keeps multi-MB output out of memory while still
+        # letting a failed run become a JSON error instead of a cut-off file;
+        # the timeout covers only generation, not the client's download
+        with tempfile.TemporaryFile() as spool:
+            # Only the run itself takes a generator slot, not the download
+            with _GEN_SEM:
+                result = run_generator(args, timeout=timeout, stdout=spool)
+            
+            if result.returncode != 0:
+                error_msg = result.stderr.decode() if result.stderr else "Unknown error"
+                self.send_json({"error": error_msg}, status=500)
+                return
+            
+            size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+            if size <= SPOOL_CACHE_LIMIT:
+                output = spool.read()
+                _OUTPUT_CACHE.put(output_key, output)
+                self.send_file_response(output, filename, content_type)
+                return
+            
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+            self.send_header("Content-Length", size)
+            self.send_cors_headers()
+            self.end_headers()
+            self.connection.sendfile(spool, 0, size)
+    
     def handle_generate(self, query_string):
         """Generate puzzle box using the C binary"""
-        params = parse_qs(query_string)
+        params = dict(parse_qsl(query_string))
+        
+        # Each run draws a new random maze, so cached output is only reused when
+        # the frontend regenerates settings restored from a share ID (shared=1).
+        # The flag itself is not part of the share ID.
+        reuse_cached = params.pop('shared', '').lower() in ('1', 'true', 'on')
+        
+        # Canonical parameter string, computed once and shared by cache key and share ID
+        param_bytes = _canonical_params(params)
+        share_id = _b64id(param_bytes)
         
         # Check for polyhedron extraction mode (for MakerWorld)
-        extract_polyhedron = 'polyhedron' in params and params['polyhedron'][0].lower() in ('1', 'true', 'on')
+        extract_polyhedron = params.get('polyhedron', '').lower() in ('1', 'true', 'on')
         
         # Build command line arguments
         args = [str(GENERATOR_PATH)]
         
-        # Map URL parameters to command line options
-        param_map = {
-            # Flags (no value)
-            'l': '--stl',
-            'R': '--resin',
-            'i': '--inside',
-            'f': '--flip',
-            'q': '--core-solid',
-            'v': '--park-vertical',
-            'W': '--base-wide',
-            'd': '--text-slow',
-            'O': '--text-outset',
-            'V': '--symmetric-cut',
-            'Q': '--test',
-            # Values
-            'm': '--parts',
-            'c': '--core-diameter',
-            'h': '--core-height',
-            'C': '--core-gap',
-            'E': '--text-end',
-            'I': '--text-inside',
-            'S': '--text-side',
-            'n': '--part',
-            'N': '--nubs',
-            'H': '--helix',
-            'b': '--base-height',
-            'w': '--part-thickness',
-            't': '--maze-thickness',
-            'z': '--maze-step',
-            'M': '--maze-margin',
-            'X': '--maze-complexity',
-            'p': '--park-thickness',
-            'B': '--base-thickness',
-            'Z': '--base-gap',
-            'g': '--clearance',
-            'y': '--nub-r-clearance',
-            's': '--outer-sides',
-            'r': '--outer-round',
-            'G': '--grip-depth',
-            'D': '--text-depth',
-            'F': '--text-font',
-            'e': '--text-font-end',
-            'T': '--text-side-scale',
-            'U': '--text-end-scale',
-            'J': '--text-inside-scale',
-            'L': '--logo-depth',
-        }
-        
-        # Flags that don't take values
-        flag_params = {'l', 'R', 'i', 'f', 'q', 'v', 'W', 'd', 'O', 'V', 'Q'}
-        
         generate_stl = False
         
         # Check if physical watermark is enabled (hidden signature in slicer only)
-        add_physical_watermark = 'watermark' in params and params['watermark'][0].lower() in ('1', 'true', 'on')
+        add_physical_watermark = params.get('watermark', '').lower() in ('1', 'true', 'on')
         
-        for short, long_opt in param_map.items():
-            if short in params:
-                value = params[short][0] if params[short] else ""
-                
-                if short in flag_params:
-                    if value and value.lower() not in ('', '0', 'false', 'off'):
-                        args.append(long_opt)
-                        if short == 'l':
-                            generate_stl = True
-                else:
-                    if value and value.strip():
-                        args.append(f"{long_opt}={value}")
+        # Map URL parameters to command line options
+        for short, long_opt, is_flag in GENERATOR_OPTIONS:
+            value = params.get(short)
+            if not value:
+                continue
+            
+            if is_flag:
+                if value.lower() not in ('0', 'false', 'off'):
+                    args.append(long_opt)
+                    if short == 'l':
+                        generate_stl = True
+            elif value.strip():
+                # popt takes "--opt value" as well as "--opt=value"
+                args.append(long_opt)
+                args.append(value)
+        
+        if generate_stl:
+            filename = self.build_filename(params) + ".stl"
+            content_type = "model/stl"
+        else:
+            filename = self.build_filename(params) + ".scad"
+            content_type = "application/x-openscad"
+        
+        # Every run is cached, but only share ID regenerations are served from it
+        output_key = (_generator_signature(), tuple(args))
+        parts_key = (output_key[0], param_bytes, add_physical_watermark)
         
         try:
-            result = subprocess.run(
-                args,
-                capture_output=True,
-                timeout=120,
-                cwd=str(GENERATOR_PATH.parent)
-            )
-            
-            if result.returncode != 0:
-                error_msg = result.stderr.decode() if result.stderr else "Unknown error"
-                self.send_json({"error": error_msg}, status=500)
-                return
+            if extract_polyhedron and reuse_cached:
+                payload = _PARTS_CACHE.get(parts_key)
+                if payload is not None:
+                    self.send_json(payload)
+                    return
             
-            output = result.stdout
+            output = _OUTPUT_CACHE.get(output_key) if reuse_cached else None
+            if output is None:
+                if not extract_polyhedron:
+                    # Downloads need no parsing, so don't buffer them
+                    self.send_generator_output(args, output_key, filename, content_type)
+                    return
+                
+                with _GEN_SEM:
+                    result = run_generator(args, timeout=120)
+                
+                if result.returncode != 0:
+                    error_msg = result.stderr.decode() if result.stderr else "Unknown error"
+                    self.send_json({"error": error_msg}, status=500)
+                    return
+                
+                output = result.stdout
+                _OUTPUT_CACHE.put(output_key, output)
             
             # If polyhedron extraction mode, extract individual parts for MakerWorld
             if extract_polyhedron:
                 scad_content = output.decode('utf-8')
                 # Add watermarks (code + optional physical)
-                clean_scad = self.strip_header_comments(scad_content, add_physical_watermark, params)
-                parts = self.extract_individual_parts(scad_content, add_physical_watermark, params)
-                
-                # Generate share ID that can regenerate this exact puzzle
-                import base64
-                param_str = '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if v and v[0])
-                share_id = base64.urlsafe_b64encode(param_str.encode()).decode()
+                clean_scad = self.strip_header_comments(scad_content, add_physical_watermark, share_id)
+                parts = self.extract_individual_parts(scad_content, add_physical_watermark, share_id)
                 
-                self.send_json({
+                payload = {
                     "parts": parts,
                     "full_scad": clean_scad,
                     "share_id": share_id,
                     "message": "Individual parts extracted - copy each one separately"
-                })
+                }
+                _PARTS_CACHE.put(parts_key, payload)
+                self.send_json(payload)
                 return
             
-            if generate_stl:
-                filename = self.build_filename(params) + ".stl"
-                content_type = "model/stl"
-            else:
-                filename = self.build_filename(params) + ".scad"
-                content_type = "application/x-openscad"
-            
             self.send_file_response(output, filename, content_type)
             
         except subprocess.TimeoutExpired:
@@ -224,202 +453,127 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_json({"error": str(e)}, status=500)
     
-    def add_watermark(self, scad_content, add_physical=False, params=None):
+    def add_watermark(self, scad_content, add_physical=False, share_id=None):
         """Add hidden watermark signature to prove ownership"""
-        import base64
-        import hashlib
-        import time
-        
         # Always generate timestamp for the hidden _pb marker
         timestamp = int(time.time())
         
-        # Generate a reproducible ID from parameters (allows regeneration)
-        if params:
-            # Encode parameters into the ID
-            param_str = '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if v and v[0])
-            signature_hash = base64.urlsafe_b64encode(param_str.encode()).decode()[:32]
-        else:
+        # The share ID encodes the parameters (allows regeneration); without one
+        # fall back to a timestamp signature
+        if not share_id:
             signature_data = f"PuzzleBoxGen-RC-{timestamp}"
-            signature_hash = hashlib.sha256(signature_data.encode()).hexdigest()[:16]
-        
-        lines = scad_content.split('\n')
-        result_lines = []
-        
-        # Generate share ID from params
-        if params:
-            param_str = '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if v and v[0])
-            share_id = base64.urlsafe_b64encode(param_str.encode()).decode()
-        else:
-            share_id = signature_hash
-        
-        # Add OpenSCAD Customizer metadata (shows in MakerWorld Customize panel)
-        result_lines.append("/* [About This Model] */")
-        result_lines.append('_generator = "PuzzleBoxGenerator"; // Generated by')
-        result_lines.append('_site = "https://puzzlebox-r92r.onrender.com"; // Generate yours')
-        result_lines.append('_creator = "Rogerio Camorim"; // Original Creator')
-        result_lines.append('_makerworld = "https://makerworld.com/en/@camorimcanada"; // MakerWorld')
-        result_lines.append('_version = "1.0.0"; // Version')
-        result_lines.append(f'_share_id = "{share_id}"; // Share ID (use to regenerate)')
-        result_lines.append("")
-        result_lines.append("/* [Hidden] */")
-        result_lines.append("")
-        
-        watermark_added = False
-        physical_watermark_added = False
-        
-        for line in lines:
-            # Skip original header comments (we replaced them)
-            if line.startswith('// Puzzle Box Generator') or line.startswith('// Created '):
-                continue
-            if line.startswith('// ') and '=' in line and ':' not in line:
-                continue  # Skip parameter comments
-            
-            result_lines.append(line)
-            
-            # Add hidden watermark inside the scale block (looks like valid OpenSCAD)
-            if not watermark_added and 'scale(0.001)' in line:
-                result_lines.append(f"_v=[82,67,{timestamp % 100000}];")
-                watermark_added = True
-            
-            # Physical watermark is handled in extract_individual_parts for cleaner difference() wrapping
-        
-        return '\n'.join(result_lines)
+            share_id = hashlib.sha256(signature_data.encode()).hexdigest()[:16]
+        
+        # Skip original header comments (we replaced them) by slicing around them
+        body_pieces = []
+        pos = 0
+        for line_start in _iter_line_prefix(scad_content, '// '):
+            line_end = _line_end(scad_content, line_start)
+            line = scad_content[line_start:line_end]
+            if line.startswith(('// Puzzle Box Generator', '// Created ')) or ('=' in line and ':' not in line):
+                body_pieces.append(scad_content[pos:line_start])
+                pos = line_end + 1
+        body_pieces.append(scad_content[pos:])
+        body = ''.join(body_pieces)
+        
+        # Add hidden watermark inside the scale block (looks like valid OpenSCAD)
+        scale_idx = body.find('scale(0.001)')
+        if scale_idx >= 0:
+            line_end = _line_end(body, scale_idx)
+            body = f"{body[:line_end]}\n_v=[82,67,{timestamp % 100000}];{body[line_end:]}"
+        
+        # Physical watermark is handled in extract_individual_parts for cleaner difference() wrapping
+        
+        # Add OpenSCAD Customizer metadata in front
+        return (_WATERMARK_HEADER_TMPL % ('', share_id)) + body
     
-    def strip_header_comments(self, scad_content, add_physical=False, params=None):
+    def strip_header_comments(self, scad_content, add_physical=False, share_id=None):
         """Add watermark instead of stripping - for ownership proof"""
-        return self.add_watermark(scad_content, add_physical, params)
+        return self.add_watermark(scad_content, add_physical, share_id)
     
-    def extract_individual_parts(self, scad_content, add_physical_watermark=False, params=None):
+    def extract_individual_parts(self, scad_content, add_physical_watermark=False, share_id=None):
         """Extract each part as a complete, standalone OpenSCAD file"""
         parts = []
-        lines = scad_content.split('\n')
-        
-        # Extract header comments and modules
-        header_lines = []
-        module_lines = []
-        in_scale_block = False
-        scale_line_idx = -1
-        
-        for i, line in enumerate(lines):
-            if line.startswith('//'):
-                header_lines.append(line)
-            elif line.startswith('module '):
-                module_lines.append(line)
-            elif line.startswith('scale('):
-                scale_line_idx = i
-                break
-        
-        # Find part boundaries within the scale block
+        
+        # Modules are defined before the scale block
+        scale_start = next(_iter_line_prefix(scad_content, 'scale('), len(scad_content))
+        module_lines = [scad_content[i:_line_end(scad_content, i)]
+                        for i in _iter_line_prefix(scad_content, 'module ', 0, scale_start)]
+        
+        # Find part boundaries as offsets of their "// Part N" comments
+        part_starts = self.find_part_starts(scad_content)
         part_ranges = []
-        current_part_start = -1
-        current_part_name = ""
-        
-        for i, line in enumerate(lines):
-            if '// Part ' in line and line.strip().startswith('// Part '):
-                # Save previous part
-                if current_part_start >= 0:
-                    part_ranges.append((current_part_start, i, current_part_name))
-                
-                # Start new part
-                match = re.search(r'// (Part \d+)', line)
-                if match:
-                    current_part_name = match.group(1)
-                    current_part_start = i
-        
-        # Add last part (ends at closing brace)
-        if current_part_start >= 0:
-            # Find the closing brace of scale block
-            end_idx = len(lines) - 1
-            for i in range(len(lines) - 1, current_part_start, -1):
-                if lines[i].strip() == '}':
-                    end_idx = i
-                    break
-            part_ranges.append((current_part_start, end_idx, current_part_name))
-        
-        # Generate reproducible signature from parameters
-        import base64
-        import time
+        
+        # Last part ends at the closing brace of the scale block (else the last line)
+        last_end = _last_brace_line(scad_content, part_starts[-1][0]) if part_starts else -1
+        if last_end < 0:
+            last_end = scad_content.rfind('\n') + 1
+        
+        for idx, (start, part_name) in enumerate(part_starts):
+            end = part_starts[idx + 1][0] if idx + 1 < len(part_starts) else last_end
+            part_ranges.append((start, end, part_name))
+        
+        # Share ID encodes the parameters; without one use a timestamp signature
         timestamp = int(time.time())
         
-        if params:
-            param_str = '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if v and v[0])
-            signature_hash = base64.urlsafe_b64encode(param_str.encode()).decode()[:24]
-        else:
-            import hashlib
+        if not share_id:
             signature_data = f"PuzzleBoxGen-RC-{timestamp}"
-            signature_hash = hashlib.sha256(signature_data.encode()).hexdigest()[:16]
+            share_id = hashlib.sha256(signature_data.encode()).hexdigest()[:16]
+        
+        # Everything but the part geometry is the same for every part: build it once
+        # Hidden ownership watermark header ({PART_NAME} is filled in below)
+        header = _WATERMARK_HEADER_TMPL % ('_part = "{PART_NAME}"; // Part Name\n', share_id)
+        
+        # Add modules
+        code_head = module_lines + [""] if module_lines else []
+        
+        # Add scale wrapper around the part content
+        # Add RC watermark cutout to ALL parts when watermark is enabled
+        if add_physical_watermark:
+            code_head += [
+                "scale(0.001) difference() {",
+                f"  _v=[82,67,{timestamp % 100000}];",
+                "  union() {",
+            ]
+            # Close union, add hidden geometry (only in first 0.4mm of base)
+            code_tail = [
+                "  }",
+                "  translate([0,0,200])linear_extrude(height=400,convexity=2)",
+                "    text(str(chr(82),chr(67)),size=3000,font=\"Liberation Sans:style=Bold\",halign=\"center\",valign=\"center\");",
+                "}",
+            ]
+            indent = "    "
+        else:
+            code_head += [
+                "scale(0.001) {",
+                f"  _v=[82,67,{timestamp % 100000}];",
+            ]
+            code_tail = ["}"]  # Close scale
+            indent = "  "
         
         # Build each part as complete OpenSCAD
         raw_parts = []
         
-        for start_idx, end_idx, part_name in part_ranges:
-            part_lines = lines[start_idx:end_idx]
-            
-            # Generate share ID from params
-            import base64 as b64
-            if params:
-                param_str = '&'.join(f"{k}={v[0]}" for k, v in sorted(params.items()) if v and v[0])
-                share_id = b64.urlsafe_b64encode(param_str.encode()).decode()
-            else:
-                share_id = signature_hash
-            
-            # Build complete code with hidden ownership watermark
-            code_lines = []
-            # OpenSCAD Customizer metadata (shows in MakerWorld Customize panel)
-            code_lines.append("/* [About This Model] */")
-            code_lines.append('_part = "{PART_NAME}"; // Part Name')
-            code_lines.append('_generator = "PuzzleBoxGenerator"; // Generated by')
-            code_lines.append('_site = "https://puzzlebox-r92r.onrender.com"; // Generate yours')
-            code_lines.append('_creator = "Rogerio Camorim"; // Original Creator')
-            code_lines.append('_makerworld = "https://makerworld.com/en/@camorimcanada"; // MakerWorld')
-            code_lines.append('_version = "1.0.0"; // Version')
-            code_lines.append(f'_share_id = "{share_id}"; // Share ID (use to regenerate)')
-            code_lines.append("")
-            code_lines.append("/* [Hidden] */")
-            code_lines.append("")
-            
-            # Add modules
-            for mod in module_lines:
-                code_lines.append(mod)
-            if module_lines:
-                code_lines.append("")
-            
-            # Add scale wrapper and part content
-            # Add RC watermark cutout to ALL parts when watermark is enabled
-            if add_physical_watermark:
-                code_lines.append("scale(0.001) difference() {")
-                code_lines.append(f"  _v=[82,67,{timestamp % 100000}];")
-                code_lines.append("  union() {")
-                indent = "    "
-            else:
-                code_lines.append("scale(0.001) {")
-                code_lines.append(f"  _v=[82,67,{timestamp % 100000}];")
-                indent = "  "
+        for start, end, part_name in part_ranges:
+            part_lines = scad_content[start:end].split('\n')
+            code_lines = code_head.copy()
             
             for line in part_lines:
                 stripped = line.strip()
                 if not stripped:
                     continue
                 # Skip the positioning translate (first one with large coordinates)
-                if stripped.startswith('translate([') and any(c.isdigit() for c in stripped[:30]):
+                if stripped.startswith('translate(['):
                     # Check if it's a large positioning translate (> 10000)
-                    nums = re.findall(r'\d+', stripped[:50])
-                    if nums and int(nums[0]) > 10000:
+                    num = _NUM_RE.search(stripped, 0, 50)
+                    if num and num.start() < 30 and int(num.group()) > 10000:
                         continue
                 code_lines.append(f"{indent}{stripped}")
             
-            if add_physical_watermark:
-                # Close union, add hidden geometry (only in first 0.4mm of base)
-                code_lines.append("  }")
-                code_lines.append("  translate([0,0,200])linear_extrude(height=400,convexity=2)")
-                code_lines.append("    text(str(chr(82),chr(67)),size=3000,font=\"Liberation Sans:style=Bold\",halign=\"center\",valign=\"center\");")
-                code_lines.append("}")
-            else:
-                code_lines.append("}")  # Close scale
-            
+            code_lines += code_tail
             raw_parts.append({
                 "original_name": part_name,
-                "code": '\n'.join(code_lines)
+                "code": header + '\n'.join(code_lines)
             })
         
         # Reverse order: generator outputs inner→outer, we want outer→inner
@@ -447,45 +601,45 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         
         return parts
     
+    def find_part_starts(self, scad_content):
+        """Locate the "// Part N" comments as (offset, part name) pairs"""
+        part_starts = []
+        for idx in _iter_line_prefix(scad_content, '// Part ', indented=True):
+            match = _PART_RE.match(scad_content, idx)
+            if match:
+                part_starts.append((idx, match.group(1)))
+        return part_starts
+    
     def extract_polyhedrons(self, scad_content):
         """Extract complete, valid OpenSCAD code for each part"""
         parts = []
-        lines = scad_content.split('\n')
         
         # First, extract module definitions (needed for complete code)
-        modules = []
-        for line in lines:
-            if line.startswith('module '):
-                modules.append(line)
+        modules = [scad_content[i:_line_end(scad_content, i)]
+                   for i in _iter_line_prefix(scad_content, 'module ')]
         
         # Find part boundaries
-        part_starts = []
-        for i, line in enumerate(lines):
-            if line.strip().startswith('// Part '):
-                match = re.search(r'// (Part \d+)', line)
-                if match:
-                    part_starts.append((i, match.group(1), line.strip()))
+        part_starts = self.find_part_starts(scad_content)
+        
+        # The closing brace of the scale block ends the last part
+        last_end = _last_brace_line(scad_content, part_starts[-1][0]) if part_starts else -1
+        if last_end < 0:
+            last_end = len(scad_content)
         
         # Extract each part
-        for idx, (start_line, part_name, part_comment) in enumerate(part_starts):
+        for idx, (start, part_name) in enumerate(part_starts):
             # Find end of this part (start of next part or end of scale block)
-            if idx + 1 < len(part_starts):
-                end_line = part_starts[idx + 1][0]
-            else:
-                # Find the closing brace of scale block
-                end_line = len(lines)
-                for i in range(len(lines) - 1, start_line, -1):
-                    if lines[i].strip() == '}':
-                        end_line = i
-                        break
+            end = part_starts[idx + 1][0] if idx + 1 < len(part_starts) else last_end
             
-            # Extract part lines (skip the comment line itself)
-            part_lines = lines[start_line + 1:end_line]
+            # Split off the comment line itself
+            comment_end = min(_line_end(scad_content, start), end)
+            part_comment = scad_content[start:comment_end].strip()
+            part_content = scad_content[comment_end + 1:end]
             
             # Check if there's actual geometry
-            part_content = '\n'.join(part_lines)
             if 'polyhedron(' not in part_content:
                 continue
+            part_lines = part_content.split('\n')
             
             # Build complete OpenSCAD code for this part
             code = self.build_complete_part(part_name, part_comment, part_lines, modules)
@@ -517,13 +671,7 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         code_lines.append(f"  {part_comment}")
         
         # Add the part geometry
-        # Include all geometry primitives, not just polyhedron
-        geometry_keywords = ['polyhedron(', 'cylinder(', 'cube(', 'sphere(', 
-                            'rotate(', 'for(', 'translate(', 'difference(', 
-                            'union(', 'intersection(', 'hull(', 'minkowski(']
-        
-        # Track brace depth to handle nested structures
-        content = '\n'.join(part_lines)
+        # Include all geometry primitives (_GEOMETRY_KEYWORDS), not just polyhedron
         
         # Remove leading translate that positions the part (first one only)
         # Keep other translates that are part of the geometry
@@ -541,7 +689,7 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
                 continue
             
             # Include geometry-related lines
-            if any(kw in stripped for kw in geometry_keywords) or stripped in ['{', '}', '};']:
+            if any(kw in stripped for kw in _GEOMETRY_KEYWORDS) or stripped in ('{', '}', '};'):
                 filtered_lines.append(stripped)
         
         # Join and add proper indentation
@@ -556,14 +704,14 @@ class PuzzleBoxHandler(SimpleHTTPRequestHandler):
         """Build a descriptive filename"""
         parts = ["puzzlebox"]
         
-        if 'm' in params and params['m'][0]:
-            parts.append(f"{params['m'][0]}parts")
-        if 'c' in params and params['c'][0]:
-            parts.append(f"{params['c'][0]}c")
-        if 'h' in params and params['h'][0]:
-            parts.append(f"{params['h'][0]}h")
-        if 'X' in params and params['X'][0]:
-            parts.append(f"X{params['X'][0]}")
+        if params.get('m'):
+            parts.append(f"{params['m']}parts")
+        if params.get('c'):
+            parts.append(f"{params['c']}c")
+        if params.get('h'):
+            parts.append(f"{params['h']}h")
+        if params.get('X'):
+            parts.append(f"X{params['X']}")
         
         return "-".join(parts)
     
@@ -604,6 +752,23 @@ def build_generator():
         return False
 
 
+def load_static_files():
+    """Open the top-level frontend files once so GETs can use sendfile()"""
+    for path in sorted(STATIC_DIR.iterdir()):
+        if path.name.startswith('.') or not path.is_file():
+            continue
+        file = open(path, 'rb')
+        st = os.fstat(file.fileno())
+        etag = '"%s"' % hashlib.sha1(file.read()).hexdigest()[:16]
+        content_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        STATIC_FILES['/' + path.name] = (file, st.st_size, etag, content_type, last_modified)
+    
+    # "/" serves index.html, as SimpleHTTPRequestHandler does
+    if '/index.html' in STATIC_FILES:
+        STATIC_FILES['/'] = STATIC_FILES['/index.html']
+
+
 def main():
     """Start the server"""
     # Build generator if needed
@@ -624,12 +789,17 @@ def main():
     except:
         pass
     
+    load_static_files()
+    
     print(f"\n🧩 Puzzle Box Generator")
     print(f"   Server running at: http://localhost:{PORT}")
     print(f"   Generator: {GENERATOR_PATH}")
     print(f"\n   Press Ctrl+C to stop\n")
     
-    server = HTTPServer(("", PORT), PuzzleBoxHandler)
+    # One thread per connection so a slow client or a long generation doesn't
+    # stall everyone else; daemon threads let Ctrl+C exit immediately
+    server = ThreadingHTTPServer(("", PORT), PuzzleBoxHandler)
+    server.daemon_threads = True
     
     try:
         server.serve_forever()
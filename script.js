@@ -4,6 +4,10 @@
 
 const API_BASE = window.location.origin;
 
+// True while the form holds settings restored from a Share ID; the server then
+// returns that puzzle again instead of generating a new random maze
+let restoredFromShareId = false;
+
 document.addEventListener('DOMContentLoaded', () => {
     initSliders();
     initFormSubmission();
@@ -146,6 +150,13 @@ function initFormSubmission() {
     const downloadBtn = document.getElementById('downloadBtn');
     const stlBtn = document.getElementById('stlBtn');
     
+    // Any edit means a new puzzle rather than the shared one
+    if (form) {
+        form.addEventListener('input', () => {
+            restoredFromShareId = false;
+        });
+    }
+    
     if (downloadBtn) {
         downloadBtn.addEventListener('click', async (e) => {
             e.preventDefault();
@@ -232,6 +243,10 @@ async function generatePuzzleBox(format) {
         params.append('polyhedron', '1');
     }
     
+    if (restoredFromShareId) {
+        params.append('shared', '1');
+    }
+    
     // Collect all form values
     const inputs = form.querySelectorAll('input');
     
@@ -829,6 +844,7 @@ function applyPreset(presetName) {
     if (!preset) return;
     
     const form = document.getElementById('puzzleForm');
+    restoredFromShareId = false;
     
     // Reset all inputs first
     form.querySelectorAll('input').forEach(input => {
@@ -904,6 +920,7 @@ async function importShareId() {
             // Update sliders display and maze rows
             initSliders();
             calculateMazeRows();
+            restoredFromShareId = true;
             
             showNotification('Settings restored from Share ID!', 'success');
             shareInput.value = '';  // Clear the input